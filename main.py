@@ -1,14 +1,22 @@
 import asyncio
+import atexit
+import heapq
 import json
 import logging
 import os
+import queue
 import sqlite3
-from dataclasses import dataclass
-from datetime import datetime, timedelta, timezone
-from logging.handlers import RotatingFileHandler
-from typing import Optional
-
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from pathlib import Path
+from typing import Awaitable, Callable, Optional
+
+import orjson
 from aiogram import Bot, Dispatcher, F, Router
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command, CommandStart, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
@@ -29,6 +37,8 @@ LOG_PATH = os.getenv("BOT_LOG_PATH", "bot.log")
 ANALYTICS_DB_PATH = os.getenv("ANALYTICS_DB_PATH", "analytics.sqlite")
 SUPPORT_REMINDER_SECONDS = int(os.getenv("SUPPORT_REMINDER_SECONDS", "600"))
 SUPPORT_REMINDER_MAX = int(os.getenv("SUPPORT_REMINDER_MAX", "3"))
+STATS_CACHE_SECONDS = int(os.getenv("STATS_CACHE_SECONDS", "60"))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "50000"))
 TEXTS_PATH = os.getenv("BOT_TEXTS_PATH", "texts.json")
 DEFAULT_LANG = os.getenv("BOT_DEFAULT_LANG", "ru").lower()
 TEXTS_EN_PATH = os.getenv("BOT_TEXTS_EN_PATH", "texts.en.json")
@@ -40,8 +50,7 @@ TEXTS_TG_PATH = os.getenv("BOT_TEXTS_TG_PATH", "texts.tg.json")
 
 
 def load_texts(path: str) -> dict:
-    with open(path, "r", encoding="utf-8") as handle:
-        return json.load(handle)
+    return orjson.loads(Path(path).read_bytes())
 
 
 def load_optional_texts(path: str) -> Optional[dict]:
@@ -82,138 +91,312 @@ def configure_logging(log_path: str) -> None:
     handler = RotatingFileHandler(log_path, maxBytes=1_000_000, backupCount=3)
     formatter = logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s")
     handler.setFormatter(formatter)
-    logging.getLogger().addHandler(handler)
+    root = logging.getLogger()
+    handlers = [*root.handlers, handler]
+    for existing in root.handlers[:]:
+        root.removeHandler(existing)
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    root.addHandler(QueueHandler(log_queue))
+
+
+INSERT_EVENT_SQL = """
+    INSERT INTO events (ts, event_type, subject, user_id, username, full_name, chat_id, data)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+STATS_BY_EVENT_SQL = """
+    SELECT event_type, COUNT(*)
+    FROM events
+    WHERE ts >= ? AND ts < ?
+    GROUP BY event_type
+    ORDER BY COUNT(*) DESC
+"""
+STATS_UNIQUE_USERS_SQL = "SELECT COUNT(DISTINCT user_id) FROM events WHERE ts >= ? AND ts < ?"
+STATS_TOP_SUBJECTS_SQL = """
+    SELECT event_type, subject, COUNT(*)
+    FROM events
+    WHERE event_type IN (?, ?) AND ts >= ? AND ts < ?
+    GROUP BY event_type, subject
+    ORDER BY COUNT(*) DESC
+"""
+
+DAY_MS = 86_400_000
+ANALYTICS_BATCH_SIZE = 200
+ANALYTICS_FLUSH_INTERVAL_MS = 100
+
+ANALYTICS_WRITERS: dict[str, sqlite3.Connection] = {}
+ANALYTICS_READERS: dict[str, sqlite3.Connection] = {}
+ANALYTICS_WRITE_LOCK = threading.Lock()
+ANALYTICS_READ_LOCK = threading.Lock()
+# created in start_analytics_writer so it binds to the running loop
+ANALYTICS_QUEUE: Optional[asyncio.Queue] = None
+
+
+def apply_analytics_pragmas(conn: sqlite3.Connection) -> None:
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-65536")
+    conn.execute("PRAGMA mmap_size=268435456")
+
+
+def open_analytics_conn(db_path: str) -> sqlite3.Connection:
+    conn = sqlite3.connect(
+        db_path,
+        check_same_thread=False,
+        isolation_level=None,
+        cached_statements=256,
+    )
+    apply_analytics_pragmas(conn)
+    return conn
 
 
-def init_analytics_db(db_path: str) -> None:
-    conn = sqlite3.connect(db_path)
+def get_analytics_writer(db_path: str) -> sqlite3.Connection:
+    conn = ANALYTICS_WRITERS.get(db_path)
+    if conn is None:
+        conn = ANALYTICS_WRITERS[db_path] = open_analytics_conn(db_path)
+    return conn
+
+
+def get_analytics_reader(db_path: str) -> sqlite3.Connection:
+    conn = ANALYTICS_READERS.get(db_path)
+    if conn is None:
+        conn = ANALYTICS_READERS[db_path] = open_analytics_conn(db_path)
+    return conn
+
+
+CREATE_MEDIA_CACHE_SQL = """
+    CREATE TABLE IF NOT EXISTS media_cache (
+        bot_id INTEGER NOT NULL,
+        path TEXT NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        file_id TEXT NOT NULL,
+        PRIMARY KEY (bot_id, path)
+    )
+"""
+CREATE_EVENTS_SQL = """
+    CREATE TABLE IF NOT EXISTS events (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        ts INTEGER NOT NULL,
+        event_type TEXT NOT NULL,
+        subject TEXT,
+        user_id INTEGER,
+        username TEXT,
+        full_name TEXT,
+        chat_id INTEGER,
+        data TEXT
+    )
+"""
+
+
+def migrate_events_ts(conn: sqlite3.Connection) -> None:
+    columns = {row[1]: row[2] for row in conn.execute("PRAGMA table_info(events)")}
+    if columns.get("ts") != "TEXT":
+        return
+    logger.info("Migrating analytics events.ts from ISO text to epoch milliseconds")
+    conn.execute("BEGIN")
     try:
-        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("ALTER TABLE events RENAME TO events_text_ts")
+        conn.execute(CREATE_EVENTS_SQL)
         conn.execute(
             """
-            CREATE TABLE IF NOT EXISTS events (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                ts TEXT NOT NULL,
-                event_type TEXT NOT NULL,
-                subject TEXT,
-                user_id INTEGER,
-                username TEXT,
-                full_name TEXT,
-                chat_id INTEGER,
-                data TEXT
-            )
+            INSERT INTO events (id, ts, event_type, subject, user_id, username, full_name, chat_id, data)
+            SELECT id, CAST(ROUND((julianday(ts) - 2440587.5) * 86400000) AS INTEGER),
+                   event_type, subject, user_id, username, full_name, chat_id, data
+            FROM events_text_ts
             """
         )
-        conn.commit()
-    finally:
-        conn.close()
+        conn.execute("DROP TABLE events_text_ts")
+        conn.execute("COMMIT")
+    except Exception:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+
+
+def init_analytics_db(db_path: str) -> None:
+    with ANALYTICS_WRITE_LOCK:
+        conn = get_analytics_writer(db_path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(CREATE_EVENTS_SQL)
+        conn.execute(CREATE_MEDIA_CACHE_SQL)
+        migrate_events_ts(conn)
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_events_ts_type_user "
+            "ON events(ts, event_type, user_id)"
+        )
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_events_type_ts_subject "
+            "ON events(event_type, ts, subject)"
+        )
 
 
 def record_event(
-    db_path: str,
     event_type: str,
     user,
     chat_id: Optional[int],
     subject: Optional[str] = None,
     data: Optional[dict] = None,
 ) -> None:
-    payload = json.dumps(data or {})
+    payload = json.dumps(data, separators=(",", ":")) if data else "{}"
     user_id = user.id if user else None
     username = user.username if user else None
     full_name = user.full_name if user else None
-    ts = datetime.now(timezone.utc).isoformat()
+    ts = time.time_ns() // 1_000_000
+    if ANALYTICS_QUEUE is None:
+        logger.warning("Analytics writer is not running, dropping %s", event_type)
+        return
+    ANALYTICS_QUEUE.put_nowait(
+        (ts, event_type, subject, user_id, username, full_name, chat_id, payload)
+    )
 
-    try:
-        conn = sqlite3.connect(db_path)
+
+def flush_analytics_batch(db_path: str, rows: list[tuple]) -> None:
+    with ANALYTICS_WRITE_LOCK:
+        conn = get_analytics_writer(db_path)
+        conn.execute("BEGIN")
         try:
-            conn.execute(
-                """
-                INSERT INTO events (ts, event_type, subject, user_id, username, full_name, chat_id, data)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                """,
-                (ts, event_type, subject, user_id, username, full_name, chat_id, payload),
+            conn.executemany(INSERT_EVENT_SQL, rows)
+            conn.execute("COMMIT")
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+
+
+async def analytics_writer(db_path: str, events: asyncio.Queue) -> None:
+    batch: list[tuple] = []
+    flush: Optional[asyncio.Future] = None
+    try:
+        while True:
+            batch.append(await events.get())
+            if events.qsize() < ANALYTICS_BATCH_SIZE - 1:
+                await asyncio.sleep(ANALYTICS_FLUSH_INTERVAL_MS / 1000)
+            while not events.empty() and len(batch) < ANALYTICS_BATCH_SIZE:
+                batch.append(events.get_nowait())
+            rows, batch = batch, []
+            # shielded: cancelling to_thread before a worker picks it up drops the batch
+            flush = asyncio.ensure_future(
+                asyncio.to_thread(flush_analytics_batch, db_path, rows)
             )
-            conn.commit()
-        finally:
+            try:
+                await asyncio.shield(flush)
+            except Exception:
+                logger.exception("Failed to record %s analytics events", len(rows))
+    finally:
+        if flush is not None and not flush.done():
+            await asyncio.wait({flush})
+            if flush.exception():
+                logger.error(
+                    "Failed to record analytics events", exc_info=flush.exception()
+                )
+        while not events.empty():
+            batch.append(events.get_nowait())
+        if batch:
+            try:
+                flush_analytics_batch(db_path, batch)
+            except Exception:
+                logger.exception("Failed to record %s analytics events", len(batch))
+
+
+def start_analytics_writer(db_path: str) -> asyncio.Task:
+    global ANALYTICS_QUEUE
+    ANALYTICS_QUEUE = asyncio.Queue()
+    return asyncio.create_task(analytics_writer(db_path, ANALYTICS_QUEUE))
+
+
+def close_analytics_db() -> None:
+    with ANALYTICS_WRITE_LOCK:
+        for conn in ANALYTICS_WRITERS.values():
             conn.close()
-    except Exception:
-        logger.exception("Failed to record analytics event: %s", event_type)
+        ANALYTICS_WRITERS.clear()
+    with ANALYTICS_READ_LOCK:
+        for conn in ANALYTICS_READERS.values():
+            conn.close()
+        ANALYTICS_READERS.clear()
 
 
-def get_stats_range(db_path: str, start: datetime, end: datetime) -> dict:
-    start_ts = start.isoformat()
-    end_ts = end.isoformat()
-    conn = sqlite3.connect(db_path)
-    try:
-        cursor = conn.cursor()
-        total = cursor.execute(
-            "SELECT COUNT(*) FROM events WHERE ts >= ? AND ts < ?",
-            (start_ts, end_ts),
-        ).fetchone()[0]
-        unique_users = cursor.execute(
-            "SELECT COUNT(DISTINCT user_id) FROM events WHERE ts >= ? AND ts < ? AND user_id IS NOT NULL",
-            (start_ts, end_ts),
-        ).fetchone()[0]
-        by_event = cursor.execute(
-            """
-            SELECT event_type, COUNT(*)
-            FROM events
-            WHERE ts >= ? AND ts < ?
-            GROUP BY event_type
-            ORDER BY COUNT(*) DESC
-            """,
-            (start_ts, end_ts),
-        ).fetchall()
-        top_faq = cursor.execute(
-            """
-            SELECT subject, COUNT(*)
-            FROM events
-            WHERE event_type = ? AND ts >= ? AND ts < ?
-            GROUP BY subject
-            ORDER BY COUNT(*) DESC
-            LIMIT 5
-            """,
-            (EVENT_FAQ_ANSWER, start_ts, end_ts),
+def load_media_file_ids(db_path: str, bot_id: int) -> None:
+    with ANALYTICS_READ_LOCK:
+        rows = get_analytics_reader(db_path).execute(
+            "SELECT path, mtime_ns, file_id FROM media_cache WHERE bot_id = ?",
+            (bot_id,),
         ).fetchall()
-        top_install = cursor.execute(
+    for path, mtime_ns, file_id in rows:
+        try:
+            if os.stat(path).st_mtime_ns == mtime_ns:
+                MEDIA_FILE_ID_CACHE[path] = file_id
+        except OSError:
+            continue
+
+
+def save_media_file_id(db_path: str, bot_id: int, path: str, file_id: str) -> None:
+    mtime_ns = os.stat(path).st_mtime_ns
+    with ANALYTICS_WRITE_LOCK:
+        get_analytics_writer(db_path).execute(
             """
-            SELECT subject, COUNT(*)
-            FROM events
-            WHERE event_type = ? AND ts >= ? AND ts < ?
-            GROUP BY subject
-            ORDER BY COUNT(*) DESC
-            LIMIT 5
+            INSERT OR REPLACE INTO media_cache (bot_id, path, mtime_ns, file_id)
+            VALUES (?, ?, ?, ?)
             """,
-            (EVENT_INSTALL_ANSWER, start_ts, end_ts),
-        ).fetchall()
-        helpful = cursor.execute(
-            "SELECT COUNT(*) FROM events WHERE event_type = ? AND ts >= ? AND ts < ?",
-            (EVENT_FEEDBACK_HELPFUL, start_ts, end_ts),
-        ).fetchone()[0]
-        unhelpful = cursor.execute(
-            "SELECT COUNT(*) FROM events WHERE event_type = ? AND ts >= ? AND ts < ?",
-            (EVENT_FEEDBACK_UNHELPFUL, start_ts, end_ts),
+            (bot_id, path, mtime_ns, file_id),
+        )
+
+
+def delete_media_file_id(db_path: str, bot_id: int, path: str) -> None:
+    with ANALYTICS_WRITE_LOCK:
+        get_analytics_writer(db_path).execute(
+            "DELETE FROM media_cache WHERE bot_id = ? AND path = ?",
+            (bot_id, path),
+        )
+
+
+def get_stats_range(db_path: str, start_ts: int, end_ts: int) -> dict:
+    with ANALYTICS_READ_LOCK:
+        cursor = get_analytics_reader(db_path).cursor()
+        by_event = cursor.execute(STATS_BY_EVENT_SQL, (start_ts, end_ts)).fetchall()
+        unique_users = cursor.execute(
+            STATS_UNIQUE_USERS_SQL, (start_ts, end_ts)
         ).fetchone()[0]
-    finally:
-        conn.close()
+        top_subjects = cursor.execute(
+            STATS_TOP_SUBJECTS_SQL,
+            (EVENT_FAQ_ANSWER, EVENT_INSTALL_ANSWER, start_ts, end_ts),
+        ).fetchall()
 
+    top: dict[str, list[tuple[str, int]]] = {
+        EVENT_FAQ_ANSWER: [],
+        EVENT_INSTALL_ANSWER: [],
+    }
+    for event_type, subject, count in top_subjects:
+        if len(top[event_type]) < 5:
+            top[event_type].append((subject, count))
+    counts = dict(by_event)
     return {
         "start": start_ts,
         "end": end_ts,
-        "total": total,
+        "total": sum(counts.values()),
         "unique_users": unique_users,
         "by_event": by_event,
-        "top_faq": top_faq,
-        "top_install": top_install,
-        "helpful": helpful,
-        "unhelpful": unhelpful,
+        "top_faq": top[EVENT_FAQ_ANSWER],
+        "top_install": top[EVENT_INSTALL_ANSWER],
+        "helpful": counts.get(EVENT_FEEDBACK_HELPFUL, 0),
+        "unhelpful": counts.get(EVENT_FEEDBACK_UNHELPFUL, 0),
     }
 
 
-def get_stats(db_path: str, days: int = 7) -> dict:
-    end = datetime.now(timezone.utc)
-    start = end - timedelta(days=days)
-    return get_stats_range(db_path, start, end)
+STATS_CACHE: dict[tuple[str, int, int], tuple[float, dict]] = {}
+
+
+def get_stats(db_path: str, days: int = 7, offset_days: int = 0) -> dict:
+    key = (db_path, days, offset_days)
+    now = time.monotonic()
+    cached = STATS_CACHE.get(key)
+    if cached and now - cached[0] < STATS_CACHE_SECONDS:
+        return cached[1]
+    end_ts = time.time_ns() // 1_000_000 - offset_days * DAY_MS
+    stats = get_stats_range(db_path, end_ts - days * DAY_MS, end_ts)
+    STATS_CACHE[key] = (now, stats)
+    return stats
 
 
 def format_percent_change(current: int, previous: int, na_value: str) -> str:
@@ -230,11 +413,36 @@ class Support(StatesGroup):
     waiting_message = State()
 
 
+def parse_mode_for(text: str) -> Optional[str]:
+    return "HTML" if "<" in text or "&" in text else None
+
+
+MEDIA_FILES: dict[str, Optional[FSInputFile]] = {}
+MEDIA_FILE_ID_CACHE: dict[str, str] = {}
+
+
+def load_media(path: str) -> Optional[FSInputFile]:
+    if path not in MEDIA_FILES:
+        if os.path.exists(path):
+            MEDIA_FILES[path] = FSInputFile(path)
+        else:
+            logger.warning("Media file not found: %s", path)
+            MEDIA_FILES[path] = None
+    return MEDIA_FILES[path]
+
+
 @dataclass
 class Answer:
     text: str
     media_path: Optional[str] = None
     media_type: Optional[str] = None  # "photo" or "video"
+    media: Optional[FSInputFile] = field(default=None, init=False)
+    parse_mode: Optional[str] = field(default=None, init=False)
+
+    def __post_init__(self) -> None:
+        self.parse_mode = parse_mode_for(self.text)
+        if self.media_path:
+            self.media = load_media(self.media_path)
 
 
 def build_inline_keyboard(rows: list[list[tuple[str, str]]]) -> InlineKeyboardMarkup:
@@ -253,6 +461,7 @@ class Localized:
     install_answers: dict[str, Answer]
     subject_labels: dict[str, str]
     messages: dict[str, str]
+    answer_menus: dict[str, InlineKeyboardMarkup]
 
 
 def build_localized(texts: dict) -> Localized:
@@ -267,65 +476,87 @@ def build_localized(texts: dict) -> Localized:
     install_answers = {
         key: Answer(**value) for key, value in texts["install_answers"].items()
     }
+    messages = texts["messages"]
+    answer_menus = {
+        subject: build_answer_menu(messages, subject)
+        for subject in answers.keys() | install_answers.keys()
+    }
     return Localized(
         texts=texts,
         menus=menus,
         answers=answers,
         install_answers=install_answers,
         subject_labels=texts["subject_labels"],
-        messages=texts["messages"],
+        messages=messages,
+        answer_menus=answer_menus,
     )
 
 
-LOCALIZED_CACHE: dict[str, Localized] = {}
-USER_LANG: dict[int, str] = {}
+class LRUDict(OrderedDict):
+    def __init__(self, maxsize: int) -> None:
+        super().__init__()
+        self.maxsize = maxsize
+
+    def __setitem__(self, key, value) -> None:
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        if len(self) > self.maxsize:
+            self.popitem(last=False)
+
+    def get(self, key, default=None):
+        if key not in self:
+            return default
+        self.move_to_end(key)
+        return super().__getitem__(key)
+
+
+USER_LANG: LRUDict[int, str] = LRUDict(USER_CACHE_SIZE)
+
+
+LANGUAGE_PREFIX_MAP = {"kk": "kk", "en": "en", "ru": "ru"}
 
 
 def detect_language_code(user) -> str:
     if not user or not user.language_code:
         return DEFAULT_LANG
-    code = user.language_code.lower()
-    for prefix in ("kk", "en", "ru"):
-        if code.startswith(prefix):
-            return prefix
-    return DEFAULT_LANG
+    return LANGUAGE_PREFIX_MAP.get(user.language_code[:2].lower(), DEFAULT_LANG)
 
 
-def get_user_lang(user) -> str:
-    if user and user.id in USER_LANG:
-        return USER_LANG[user.id]
-    return detect_language_code(user)
+def get_localized_by_lang(lang: str) -> Localized:
+    return LOCALIZED_CACHE.get(lang) or LOCALIZED_CACHE[DEFAULT_LANG]
 
 
-def get_localized_by_lang(lang: str) -> Localized:
-    normalized = lang if lang in TEXTS_BY_LANG else DEFAULT_LANG
-    if normalized not in LOCALIZED_CACHE:
-        LOCALIZED_CACHE[normalized] = build_localized(TEXTS_BY_LANG[normalized])
-    return LOCALIZED_CACHE[normalized]
+def resolve_user(user) -> tuple[str, Localized]:
+    if not user:
+        return DEFAULT_LANG, get_localized_by_lang(DEFAULT_LANG)
+    lang = USER_LANG.get(user.id)
+    if lang is None:
+        lang = USER_LANG[user.id] = detect_language_code(user)
+    return lang, get_localized_by_lang(lang)
 
 
 def get_localized_for_user(user) -> Localized:
-    return get_localized_by_lang(get_user_lang(user))
+    return resolve_user(user)[1]
 
 
 SUPPORT_ANSWER_SUBJECTS = {"main:devices"}
 
 
-def build_answer_menu(localized: Localized, subject: str) -> InlineKeyboardMarkup:
+def build_answer_menu(messages: dict[str, str], subject: str) -> InlineKeyboardMarkup:
     if subject in SUPPORT_ANSWER_SUBJECTS:
         return build_inline_keyboard(
             [
                 [
-                    (localized.messages["leave_request_button"], SUPPORT_START),
-                    (localized.messages["back_button"], MAIN_MENU_OPEN),
+                    (messages["leave_request_button"], SUPPORT_START),
+                    (messages["back_button"], MAIN_MENU_OPEN),
                 ],
                 [
                     (
-                        localized.messages["feedback_helpful_button"],
+                        messages["feedback_helpful_button"],
                         f"{FEEDBACK_HELPFUL_PREFIX}{subject}",
                     ),
                     (
-                        localized.messages["feedback_unhelpful_button"],
+                        messages["feedback_unhelpful_button"],
                         f"{FEEDBACK_UNHELPFUL_PREFIX}{subject}",
                     ),
                 ],
@@ -335,15 +566,15 @@ def build_answer_menu(localized: Localized, subject: str) -> InlineKeyboardMarku
         [
             [
                 (
-                    localized.messages["feedback_helpful_button"],
+                    messages["feedback_helpful_button"],
                     f"{FEEDBACK_HELPFUL_PREFIX}{subject}",
                 ),
                 (
-                    localized.messages["feedback_unhelpful_button"],
+                    messages["feedback_unhelpful_button"],
                     f"{FEEDBACK_UNHELPFUL_PREFIX}{subject}",
                 ),
             ],
-            [(localized.messages["back_to_menu_button"], MAIN_MENU_OPEN)],
+            [(messages["back_to_menu_button"], MAIN_MENU_OPEN)],
         ]
     )
 
@@ -392,17 +623,22 @@ EVENT_SUPPORT_RESOLVED = "support_resolved"
 EVENT_FEEDBACK_HELPFUL = "feedback_helpful"
 EVENT_FEEDBACK_UNHELPFUL = "feedback_unhelpful"
 
-CANCEL_TRIGGERS = {
+CANCEL_TRIGGERS = frozenset(
     texts["messages"]["support_cancel_trigger"].casefold()
     for texts in TEXTS_BY_LANG.values()
     if "messages" in texts and "support_cancel_trigger" in texts["messages"]
-}
-if not CANCEL_TRIGGERS:
-    CANCEL_TRIGGERS = {"cancel"}
+) or frozenset({"cancel"})
+CANCEL_TRIGGER_MAX_LEN = max(map(len, CANCEL_TRIGGERS))
 
 ANSWER_KEYS = set(TEXTS_BY_LANG[DEFAULT_LANG]["answers"].keys())
 INSTALL_ANSWER_KEYS = set(TEXTS_BY_LANG[DEFAULT_LANG]["install_answers"].keys())
 
+LOCALIZED_CACHE: dict[str, Localized] = {
+    lang: build_localized(texts) for lang, texts in TEXTS_BY_LANG.items()
+}
+
+CallbackHandler = Callable[[CallbackQuery, FSMContext], Awaitable[None]]
+
 LANG_SELECT_PREFIX = "lang:"
 LANGUAGE_MENU_ROWS = [
     [("Русский", f"{LANG_SELECT_PREFIX}ru"), ("Қазақша", f"{LANG_SELECT_PREFIX}kk")],
@@ -420,25 +656,63 @@ def subject_label(localized: Localized, subject: Optional[str]) -> str:
     return localized.subject_labels.get(subject, subject)
 
 
-LAST_BOT_MESSAGE_ID: dict[int, int] = {}
-SUPPORT_PENDING: set[tuple[int, int]] = set()
-SUPPORT_REMINDER_TASKS: dict[tuple[int, int], asyncio.Task] = {}
-SUPPORT_REMINDER_COUNTS: dict[tuple[int, int], int] = {}
-SUPPORT_LANGS: dict[tuple[int, int], str] = {}
+@dataclass
+class SupportState:
+    lang: str
+    count: int = 0
+    due: float = 0.0
+
+
+# chat_id -> (message_id, is_text) of the last message the bot sent there
+LAST_BOT_MESSAGES: LRUDict[int, tuple[int, bool]] = LRUDict(USER_CACHE_SIZE)
+SUPPORT_STATES: LRUDict[tuple[int, int], SupportState] = LRUDict(USER_CACHE_SIZE)
+# (due, key) entries; stale ones are skipped when state.due no longer matches
+REMINDER_HEAP: list[tuple[float, tuple[int, int]]] = []
+# created in start_reminder_scheduler so it binds to the running loop
+REMINDER_EVENT: Optional[asyncio.Event] = None
 
 
 async def cleanup_previous_message(bot: Bot, chat_id: int) -> None:
     if not chat_id:
         return
-    message_id = LAST_BOT_MESSAGE_ID.get(chat_id)
-    if not message_id:
+    last = LAST_BOT_MESSAGES.get(chat_id)
+    if not last:
         return
+    message_id = last[0]
     try:
         await bot.delete_message(chat_id, message_id)
     except Exception:
         logger.warning("Failed to delete message %s in chat %s", message_id, chat_id)
     finally:
-        LAST_BOT_MESSAGE_ID.pop(chat_id, None)
+        LAST_BOT_MESSAGES.pop(chat_id, None)
+
+
+def remember_bot_message(chat_id: int, sent: Message) -> None:
+    LAST_BOT_MESSAGES[chat_id] = (sent.message_id, sent.text is not None)
+
+
+async def edit_previous_text(
+    bot: Bot,
+    chat_id: int,
+    message_id: int,
+    text: str,
+    reply_markup: Optional[InlineKeyboardMarkup] = None,
+) -> bool:
+    if LAST_BOT_MESSAGES.get(chat_id) != (message_id, True):
+        return False
+    try:
+        await bot.edit_message_text(
+            text=text,
+            chat_id=chat_id,
+            message_id=message_id,
+            reply_markup=reply_markup,
+            parse_mode=parse_mode_for(text),
+        )
+    except TelegramBadRequest as exc:
+        if "message is not modified" not in exc.message:
+            logger.warning("Failed to edit message %s in chat %s", message_id, chat_id)
+            return False
+    return True
 
 
 async def send_text(
@@ -448,12 +722,26 @@ async def send_text(
 ) -> Message:
     if message.chat:
         await cleanup_previous_message(message.bot, message.chat.id)
-    sent = await message.answer(text, reply_markup=reply_markup, parse_mode="HTML")
+    sent = await message.answer(
+        text, reply_markup=reply_markup, parse_mode=parse_mode_for(text)
+    )
     if message.chat:
-        LAST_BOT_MESSAGE_ID[message.chat.id] = sent.message_id
+        remember_bot_message(message.chat.id, sent)
     return sent
 
 
+async def edit_text_or_send(
+    message: Message,
+    text: str,
+    reply_markup: Optional[InlineKeyboardMarkup] = None,
+) -> Message:
+    if message.chat and await edit_previous_text(
+        message.bot, message.chat.id, message.message_id, text, reply_markup
+    ):
+        return message
+    return await send_text(message, text, reply_markup=reply_markup)
+
+
 async def send_text_by_chat(
     bot: Bot,
     chat_id: int,
@@ -461,8 +749,10 @@ async def send_text_by_chat(
     reply_markup: Optional[InlineKeyboardMarkup] = None,
 ) -> None:
     await cleanup_previous_message(bot, chat_id)
-    sent = await bot.send_message(chat_id, text, reply_markup=reply_markup, parse_mode="HTML")
-    LAST_BOT_MESSAGE_ID[chat_id] = sent.message_id
+    sent = await bot.send_message(
+        chat_id, text, reply_markup=reply_markup, parse_mode=parse_mode_for(text)
+    )
+    remember_bot_message(chat_id, sent)
 
 
 def text_preview(text: str, limit: int = 200) -> str:
@@ -477,8 +767,9 @@ def log_message_event(
     subject: Optional[str] = None,
     data: Optional[dict] = None,
 ) -> None:
-    chat_id = message.chat.id if message.chat else None
-    record_event(ANALYTICS_DB_PATH, event_type, message.from_user, chat_id, subject, data)
+    chat = message.chat
+    chat_id = chat.id if chat else None
+    record_event(event_type, message.from_user, chat_id, subject, data)
 
 
 def log_callback_event(
@@ -487,119 +778,179 @@ def log_callback_event(
     subject: Optional[str] = None,
     data: Optional[dict] = None,
 ) -> None:
-    chat_id = call.message.chat.id if call.message and call.message.chat else None
-    record_event(ANALYTICS_DB_PATH, event_type, call.from_user, chat_id, subject, data)
+    message = call.message
+    chat = message.chat if message else None
+    chat_id = chat.id if chat else None
+    record_event(event_type, call.from_user, chat_id, subject, data)
 
 
 def support_key(chat_id: int, user_id: int) -> tuple[int, int]:
     return (chat_id, user_id)
 
 
-def cancel_support_reminder(key: tuple[int, int]) -> None:
-    task = SUPPORT_REMINDER_TASKS.pop(key, None)
-    if task:
-        task.cancel()
+def push_support_reminder(key: tuple[int, int], state: SupportState) -> None:
+    state.due = time.monotonic() + SUPPORT_REMINDER_SECONDS
+    heapq.heappush(REMINDER_HEAP, (state.due, key))
+    if REMINDER_EVENT is not None:
+        REMINDER_EVENT.set()
 
 
 def clear_support_pending(chat_id: int, user_id: int) -> None:
-    key = support_key(chat_id, user_id)
-    SUPPORT_PENDING.discard(key)
-    SUPPORT_REMINDER_COUNTS.pop(key, None)
-    SUPPORT_LANGS.pop(key, None)
-    cancel_support_reminder(key)
+    SUPPORT_STATES.pop(support_key(chat_id, user_id), None)
 
 
-async def schedule_support_reminder(
-    bot: Bot, chat_id: int, user_id: int, lang: str
-) -> None:
+def schedule_support_reminder(chat_id: int, user_id: int, lang: str) -> None:
     key = support_key(chat_id, user_id)
-    SUPPORT_PENDING.add(key)
-    SUPPORT_LANGS[key] = lang
-    cancel_support_reminder(key)
-    if key not in SUPPORT_REMINDER_COUNTS:
-        SUPPORT_REMINDER_COUNTS[key] = 0
-    if SUPPORT_REMINDER_COUNTS[key] >= SUPPORT_REMINDER_MAX:
+    state = SUPPORT_STATES.get(key)
+    if state is None:
+        state = SUPPORT_STATES[key] = SupportState(lang=lang)
+    else:
+        state.lang = lang
+    if state.count >= SUPPORT_REMINDER_MAX:
         return
-    SUPPORT_REMINDER_TASKS[key] = asyncio.create_task(
-        run_support_reminder(bot, chat_id, user_id)
-    )
+    push_support_reminder(key, state)
 
 
-async def run_support_reminder(bot: Bot, chat_id: int, user_id: int) -> None:
+async def send_support_reminder(
+    bot: Bot, key: tuple[int, int], state: SupportState
+) -> None:
+    chat_id, user_id = key
+    state.count += 1
+    if state.count < SUPPORT_REMINDER_MAX:
+        push_support_reminder(key, state)
+    localized = get_localized_by_lang(state.lang)
+    record_event(
+        EVENT_SUPPORT_REMINDER,
+        None,
+        chat_id,
+        data={"user_id": user_id, "count": state.count},
+    )
     try:
-        key = support_key(chat_id, user_id)
-        while True:
-            await asyncio.sleep(SUPPORT_REMINDER_SECONDS)
-            if key not in SUPPORT_PENDING:
-                return
-            count = SUPPORT_REMINDER_COUNTS.get(key, 0)
-            if count >= SUPPORT_REMINDER_MAX:
-                return
-            SUPPORT_REMINDER_COUNTS[key] = count + 1
-            lang = SUPPORT_LANGS.get(key, DEFAULT_LANG)
-            localized = get_localized_by_lang(lang)
-            record_event(
-                ANALYTICS_DB_PATH,
-                EVENT_SUPPORT_REMINDER,
-                None,
-                chat_id,
-                data={"user_id": user_id, "count": count + 1},
-            )
-            await send_text_by_chat(
-                bot,
-                chat_id,
-                localized.messages["support_reminder"],
-                reply_markup=localized.menus["support_reminder"],
-            )
-    except asyncio.CancelledError:
-        return
+        await send_text_by_chat(
+            bot,
+            chat_id,
+            localized.messages["support_reminder"],
+            reply_markup=localized.menus["support_reminder"],
+        )
     except Exception:
         logger.exception("Failed to send support reminder")
+
+
+async def reminder_scheduler(bot: Bot, wakeup: asyncio.Event) -> None:
+    # sends run as their own tasks so one slow chat cannot hold up the rest
+    sends: set[asyncio.Task] = set()
+    try:
+        while True:
+            wakeup.clear()
+            if not REMINDER_HEAP:
+                await wakeup.wait()
+                continue
+            delay = REMINDER_HEAP[0][0] - time.monotonic()
+            if delay > 0:
+                # every reminder uses the same delay, so new entries never jump ahead
+                await asyncio.sleep(delay)
+                continue
+            due, key = heapq.heappop(REMINDER_HEAP)
+            state = SUPPORT_STATES.get(key)
+            if state is None or state.due != due or state.count >= SUPPORT_REMINDER_MAX:
+                continue
+            task = asyncio.create_task(send_support_reminder(bot, key, state))
+            sends.add(task)
+            task.add_done_callback(sends.discard)
     finally:
-        SUPPORT_REMINDER_TASKS.pop(support_key(chat_id, user_id), None)
+        for task in sends:
+            task.cancel()
+
+
+def start_reminder_scheduler(bot: Bot) -> asyncio.Task:
+    global REMINDER_EVENT
+    REMINDER_EVENT = asyncio.Event()
+    return asyncio.create_task(reminder_scheduler(bot, REMINDER_EVENT))
+
+
+async def remember_media_file_id(bot: Bot, path: str, file_id: str) -> None:
+    MEDIA_FILE_ID_CACHE[path] = file_id
+    try:
+        await asyncio.to_thread(
+            save_media_file_id, ANALYTICS_DB_PATH, bot.id, path, file_id
+        )
+    except Exception:
+        logger.exception("Failed to save file_id for %s", path)
+
+
+async def forget_media_file_id(bot: Bot, path: str) -> None:
+    MEDIA_FILE_ID_CACHE.pop(path, None)
+    try:
+        await asyncio.to_thread(delete_media_file_id, ANALYTICS_DB_PATH, bot.id, path)
+    except Exception:
+        logger.exception("Failed to delete file_id for %s", path)
+
+
+async def send_answer_media(
+    message: Message,
+    answer: Answer,
+    media,
+    reply_markup: InlineKeyboardMarkup,
+) -> tuple[Message, Optional[str]]:
+    file_id = None
+    if answer.media_type == "photo":
+        sent = await message.answer_photo(
+            media,
+            caption=answer.text,
+            reply_markup=reply_markup,
+            parse_mode=answer.parse_mode,
+        )
+        if sent.photo:
+            file_id = sent.photo[-1].file_id
+    elif answer.media_type == "video":
+        sent = await message.answer_video(
+            media,
+            caption=answer.text,
+            reply_markup=reply_markup,
+            parse_mode=answer.parse_mode,
+        )
+        if sent.video:
+            file_id = sent.video.file_id
+    else:
+        logger.warning("Unknown media_type: %s", answer.media_type)
+        sent = await message.answer(
+            answer.text,
+            reply_markup=reply_markup,
+            parse_mode=answer.parse_mode,
+        )
+    return sent, file_id
 
 
 async def send_answer(
     message: Message, localized: Localized, answer: Answer, subject: str
 ) -> None:
+    reply_markup = localized.answer_menus[subject]
+    if not answer.media:
+        await edit_text_or_send(message, answer.text, reply_markup=reply_markup)
+        return
+
     if message.chat:
         await cleanup_previous_message(message.bot, message.chat.id)
 
-    reply_markup = build_answer_menu(localized, subject)
-    if answer.media_path and os.path.exists(answer.media_path):
-        media = FSInputFile(answer.media_path)
-        if answer.media_type == "photo":
-            sent = await message.answer_photo(
-                media,
-                caption=answer.text,
-                reply_markup=reply_markup,
-                parse_mode="HTML",
-            )
-        elif answer.media_type == "video":
-            sent = await message.answer_video(
-                media,
-                caption=answer.text,
-                reply_markup=reply_markup,
-                parse_mode="HTML",
-            )
-        else:
-            logger.warning("Unknown media_type: %s", answer.media_type)
-            sent = await message.answer(
-                answer.text,
-                reply_markup=reply_markup,
-                parse_mode="HTML",
-            )
-    else:
-        if answer.media_path:
-            logger.warning("Media file not found: %s", answer.media_path)
-        sent = await message.answer(
-            answer.text,
-            reply_markup=reply_markup,
-            parse_mode="HTML",
+    cached_file_id = MEDIA_FILE_ID_CACHE.get(answer.media_path)
+    try:
+        sent, file_id = await send_answer_media(
+            message, answer, cached_file_id or answer.media, reply_markup
+        )
+    except TelegramBadRequest:
+        if cached_file_id is None:
+            raise
+        logger.warning("Cached file_id for %s rejected, re-uploading", answer.media_path)
+        await forget_media_file_id(message.bot, answer.media_path)
+        cached_file_id = None
+        sent, file_id = await send_answer_media(
+            message, answer, answer.media, reply_markup
         )
+    if file_id and cached_file_id is None:
+        await remember_media_file_id(message.bot, answer.media_path, file_id)
 
     if message.chat:
-        LAST_BOT_MESSAGE_ID[message.chat.id] = sent.message_id
+        remember_bot_message(message.chat.id, sent)
 
 
 def build_support_payload(message: Message, localized: Localized) -> str:
@@ -616,6 +967,11 @@ def build_support_payload(message: Message, localized: Localized) -> str:
     return template.format(user_id=user_id, username=username, text=text)
 
 
+async def reset_state(state: FSMContext) -> None:
+    if await state.get_state() is not None:
+        await state.clear()
+
+
 async def main() -> None:
     bot_token = os.getenv("BOT_TOKEN")
     admin_chat_id_raw = os.getenv("ADMIN_CHAT_ID")
@@ -628,30 +984,34 @@ async def main() -> None:
         admin_chat_id = int(admin_chat_id_raw)
     except ValueError as exc:
         raise RuntimeError("ADMIN_CHAT_ID must be an integer") from exc
-    init_analytics_db(ANALYTICS_DB_PATH)
+    await asyncio.to_thread(init_analytics_db, ANALYTICS_DB_PATH)
+    analytics_task = start_analytics_writer(ANALYTICS_DB_PATH)
 
     bot = Bot(token=bot_token)
+    await asyncio.to_thread(load_media_file_ids, ANALYTICS_DB_PATH, bot.id)
+    reminder_task = start_reminder_scheduler(bot)
     dp = Dispatcher(storage=MemoryStorage())
     router = Router()
 
     @router.message(CommandStart())
     async def cmd_start(message: Message, state: FSMContext) -> None:
-        await state.clear()
+        await reset_state(state)
         log_message_event(message, EVENT_START)
-        if message.from_user:
-            USER_LANG.pop(message.from_user.id, None)
+        user = message.from_user
+        if user:
+            USER_LANG.pop(user.id, None)
         await send_text(message, LANGUAGE_PROMPT, reply_markup=LANGUAGE_MENU)
 
-    @router.callback_query(F.data.startswith(LANG_SELECT_PREFIX))
     async def language_select_callback(call: CallbackQuery, state: FSMContext) -> None:
-        lang = call.data[len(LANG_SELECT_PREFIX) :]
+        lang = call.data.removeprefix(LANG_SELECT_PREFIX)
         if lang not in TEXTS_BY_LANG:
             lang = DEFAULT_LANG
-        if call.from_user:
-            USER_LANG[call.from_user.id] = lang
+        user = call.from_user
+        if user:
+            USER_LANG[user.id] = lang
         localized = get_localized_by_lang(lang)
-        await state.clear()
-        await send_text(
+        await reset_state(state)
+        await edit_text_or_send(
             call.message,
             localized.messages["welcome"],
             reply_markup=localized.menus["main"],
@@ -660,8 +1020,9 @@ async def main() -> None:
 
     @router.message(Command("stats"))
     async def cmd_stats(message: Message) -> None:
-        user_id = message.from_user.id if message.from_user else None
-        localized = get_localized_for_user(message.from_user)
+        user = message.from_user
+        user_id = user.id if user else None
+        localized = get_localized_for_user(user)
         stats_localized = get_localized_by_lang("ru")
         if message.chat.id != admin_chat_id and user_id != admin_chat_id:
             await send_text(
@@ -671,12 +1032,9 @@ async def main() -> None:
             )
             return
 
-        now = datetime.now(timezone.utc)
-        current_start = now - timedelta(days=7)
-        previous_start = now - timedelta(days=14)
-        stats = get_stats_range(ANALYTICS_DB_PATH, current_start, now)
-        previous_stats = get_stats_range(
-            ANALYTICS_DB_PATH, previous_start, current_start
+        stats = await asyncio.to_thread(get_stats, ANALYTICS_DB_PATH, 7)
+        previous_stats = await asyncio.to_thread(
+            get_stats, ANALYTICS_DB_PATH, 7, offset_days=7
         )
         log_message_event(message, EVENT_STATS, data={"days": 7})
         na_value = stats_localized.messages.get("stats_compare_na", "n/a")
@@ -743,13 +1101,19 @@ async def main() -> None:
 
         await send_text(message, "\n".join(lines), reply_markup=localized.menus["main"])
 
-    @router.message(Support.waiting_message, F.text.casefold().in_(CANCEL_TRIGGERS))
+    @router.message(
+        Support.waiting_message,
+        F.text.len() <= CANCEL_TRIGGER_MAX_LEN,
+        F.text.casefold().in_(CANCEL_TRIGGERS),
+    )
     async def support_cancel(message: Message, state: FSMContext) -> None:
+        chat = message.chat
+        user = message.from_user
         await state.clear()
         log_message_event(message, EVENT_SUPPORT_CANCEL)
-        if message.chat and message.from_user:
-            clear_support_pending(message.chat.id, message.from_user.id)
-        localized = get_localized_for_user(message.from_user)
+        if chat and user:
+            clear_support_pending(chat.id, user.id)
+        localized = get_localized_for_user(user)
         await send_text(
             message,
             localized.messages["support_cancel"],
@@ -758,9 +1122,11 @@ async def main() -> None:
 
     @router.message(Support.waiting_message)
     async def support_message(message: Message, state: FSMContext) -> None:
-        localized = get_localized_for_user(message.from_user)
-        lang = get_user_lang(message.from_user)
-        if not message.text:
+        chat = message.chat
+        user = message.from_user
+        text = message.text
+        lang, localized = resolve_user(user)
+        if not text:
             log_message_event(
                 message,
                 EVENT_SUPPORT_NON_TEXT,
@@ -771,19 +1137,17 @@ async def main() -> None:
                 localized.messages["support_non_text"],
                 reply_markup=localized.menus["support"],
             )
-            if message.chat and message.from_user:
-                await schedule_support_reminder(
-                    message.bot, message.chat.id, message.from_user.id, lang
-                )
+            if chat and user:
+                schedule_support_reminder(chat.id, user.id, lang)
             return
 
         log_message_event(
             message,
             EVENT_SUPPORT_SUBMIT,
-            data={"text_len": len(message.text), "text_preview": text_preview(message.text)},
+            data={"text_len": len(text), "text_preview": text_preview(text)},
         )
-        if message.chat and message.from_user:
-            clear_support_pending(message.chat.id, message.from_user.id)
+        if chat and user:
+            clear_support_pending(chat.id, user.id)
         await bot.send_message(admin_chat_id, build_support_payload(message, localized))
         await state.clear()
         await send_text(
@@ -792,99 +1156,96 @@ async def main() -> None:
             reply_markup=localized.menus["main"],
         )
 
-    @router.callback_query(F.data == SUPPORT_START)
     async def support_start_callback(call: CallbackQuery, state: FSMContext) -> None:
         await state.set_state(Support.waiting_message)
         log_callback_event(call, EVENT_SUPPORT_START)
-        localized = get_localized_for_user(call.from_user)
-        lang = get_user_lang(call.from_user)
-        await send_text(
+        chat = call.message.chat
+        user = call.from_user
+        lang, localized = resolve_user(user)
+        await edit_text_or_send(
             call.message,
             localized.messages["support_start_prompt"],
             reply_markup=localized.menus["support"],
         )
-        if call.message.chat and call.from_user:
-            clear_support_pending(call.message.chat.id, call.from_user.id)
-            await schedule_support_reminder(
-                call.bot, call.message.chat.id, call.from_user.id, lang
-            )
+        if chat and user:
+            clear_support_pending(chat.id, user.id)
+            schedule_support_reminder(chat.id, user.id, lang)
         await call.answer()
 
-    @router.callback_query(F.data == SUPPORT_RESOLVED)
     async def support_resolved_callback(call: CallbackQuery, state: FSMContext) -> None:
-        await state.clear()
+        await reset_state(state)
         log_callback_event(call, EVENT_SUPPORT_RESOLVED)
-        if call.message.chat and call.from_user:
-            clear_support_pending(call.message.chat.id, call.from_user.id)
-        localized = get_localized_for_user(call.from_user)
-        await send_text(
+        chat = call.message.chat
+        user = call.from_user
+        if chat and user:
+            clear_support_pending(chat.id, user.id)
+        localized = get_localized_for_user(user)
+        await edit_text_or_send(
             call.message,
             localized.messages["support_resolved"],
             reply_markup=localized.menus["main"],
         )
         await call.answer()
 
-    @router.callback_query(F.data == SUPPORT_CANCEL)
     async def support_cancel_callback(call: CallbackQuery, state: FSMContext) -> None:
-        await state.clear()
+        await reset_state(state)
         log_callback_event(call, EVENT_SUPPORT_CANCEL)
-        if call.message.chat and call.from_user:
-            clear_support_pending(call.message.chat.id, call.from_user.id)
-        localized = get_localized_for_user(call.from_user)
-        await send_text(
+        chat = call.message.chat
+        user = call.from_user
+        if chat and user:
+            clear_support_pending(chat.id, user.id)
+        localized = get_localized_for_user(user)
+        await edit_text_or_send(
             call.message,
             localized.messages["support_cancel_callback"],
             reply_markup=localized.menus["main"],
         )
         await call.answer()
 
-    @router.callback_query(F.data == MAIN_INSTALL)
     async def install_menu_callback(call: CallbackQuery, state: FSMContext) -> None:
-        await state.clear()
+        await reset_state(state)
         log_callback_event(call, EVENT_INSTALL_MENU)
         localized = get_localized_for_user(call.from_user)
-        await send_text(
+        await edit_text_or_send(
             call.message,
             localized.messages["install_menu_prompt"],
             reply_markup=localized.menus["install"],
         )
         await call.answer()
 
-    @router.callback_query(F.data.in_((MAIN_MENU_OPEN, INSTALL_BACK)))
     async def main_menu_callback(call: CallbackQuery, state: FSMContext) -> None:
-        await state.clear()
+        await reset_state(state)
         log_callback_event(call, EVENT_MAIN_MENU_OPEN, data={"source": call.data})
-        if call.message.chat and call.from_user:
-            clear_support_pending(call.message.chat.id, call.from_user.id)
-        localized = get_localized_for_user(call.from_user)
-        await send_text(
+        chat = call.message.chat
+        user = call.from_user
+        if chat and user:
+            clear_support_pending(chat.id, user.id)
+        localized = get_localized_for_user(user)
+        await edit_text_or_send(
             call.message,
             localized.messages["main_menu"],
             reply_markup=localized.menus["main"],
         )
         await call.answer()
 
-    @router.callback_query(F.data.in_(INSTALL_ANSWER_KEYS))
     async def install_answer_callback(call: CallbackQuery, state: FSMContext) -> None:
-        await state.clear()
+        await reset_state(state)
         log_callback_event(call, EVENT_INSTALL_ANSWER, subject=call.data)
         localized = get_localized_for_user(call.from_user)
         answer = localized.install_answers[call.data]
         await send_answer(call.message, localized, answer, call.data)
         await call.answer()
 
-    @router.callback_query(F.data.in_(ANSWER_KEYS))
     async def main_answer_callback(call: CallbackQuery, state: FSMContext) -> None:
-        await state.clear()
+        await reset_state(state)
         log_callback_event(call, EVENT_FAQ_ANSWER, subject=call.data)
         localized = get_localized_for_user(call.from_user)
         answer = localized.answers[call.data]
         await send_answer(call.message, localized, answer, call.data)
         await call.answer()
 
-    @router.callback_query(F.data.startswith(FEEDBACK_HELPFUL_PREFIX))
-    async def feedback_helpful_callback(call: CallbackQuery) -> None:
-        subject = call.data[len(FEEDBACK_HELPFUL_PREFIX) :]
+    async def feedback_helpful_callback(call: CallbackQuery, state: FSMContext) -> None:
+        subject = call.data.removeprefix(FEEDBACK_HELPFUL_PREFIX)
         log_callback_event(call, EVENT_FEEDBACK_HELPFUL, subject=subject)
         localized = get_localized_for_user(call.from_user)
         if call.message:
@@ -896,9 +1257,10 @@ async def main() -> None:
                 logger.warning("Failed to update feedback menu")
         await call.answer(localized.messages["feedback_thanks"])
 
-    @router.callback_query(F.data.startswith(FEEDBACK_UNHELPFUL_PREFIX))
-    async def feedback_unhelpful_callback(call: CallbackQuery) -> None:
-        subject = call.data[len(FEEDBACK_UNHELPFUL_PREFIX) :]
+    async def feedback_unhelpful_callback(
+        call: CallbackQuery, state: FSMContext
+    ) -> None:
+        subject = call.data.removeprefix(FEEDBACK_UNHELPFUL_PREFIX)
         log_callback_event(call, EVENT_FEEDBACK_UNHELPFUL, subject=subject)
         localized = get_localized_for_user(call.from_user)
         if call.message:
@@ -910,18 +1272,49 @@ async def main() -> None:
                 logger.warning("Failed to update feedback menu")
         await call.answer(localized.messages["feedback_thanks"])
 
-    @router.callback_query()
-    async def fallback_callback(call: CallbackQuery) -> None:
+    async def fallback_callback(call: CallbackQuery, state: FSMContext) -> None:
         log_callback_event(call, EVENT_FALLBACK_CALLBACK, data={"callback_data": call.data})
         localized = get_localized_for_user(call.from_user)
         await call.answer(localized.messages["fallback_callback"], show_alert=False)
 
+    callback_handlers: dict[str, CallbackHandler] = {
+        **dict.fromkeys(ANSWER_KEYS, main_answer_callback),
+        **dict.fromkeys(INSTALL_ANSWER_KEYS, install_answer_callback),
+        SUPPORT_START: support_start_callback,
+        SUPPORT_RESOLVED: support_resolved_callback,
+        SUPPORT_CANCEL: support_cancel_callback,
+        MAIN_INSTALL: install_menu_callback,
+        MAIN_MENU_OPEN: main_menu_callback,
+        INSTALL_BACK: main_menu_callback,
+    }
+    callback_prefix_handlers: tuple[tuple[str, CallbackHandler], ...] = (
+        (LANG_SELECT_PREFIX, language_select_callback),
+        (FEEDBACK_HELPFUL_PREFIX, feedback_helpful_callback),
+        (FEEDBACK_UNHELPFUL_PREFIX, feedback_unhelpful_callback),
+    )
+
+    @router.callback_query()
+    async def dispatch_callback(call: CallbackQuery, state: FSMContext) -> None:
+        data = call.data or ""
+        handler = callback_handlers.get(data)
+        if handler is None:
+            handler = next(
+                (
+                    prefix_handler
+                    for prefix, prefix_handler in callback_prefix_handlers
+                    if data.startswith(prefix)
+                ),
+                fallback_callback,
+            )
+        await handler(call, state)
+
     @router.message(StateFilter(None), F.text)
     async def fallback(message: Message) -> None:
+        text = message.text
         log_message_event(
             message,
             EVENT_FALLBACK_MESSAGE,
-            data={"text_len": len(message.text), "text_preview": text_preview(message.text)},
+            data={"text_len": len(text), "text_preview": text_preview(text)},
         )
         localized = get_localized_for_user(message.from_user)
         await send_text(
@@ -931,7 +1324,13 @@ async def main() -> None:
         )
 
     dp.include_router(router)
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        reminder_task.cancel()
+        analytics_task.cancel()
+        await asyncio.gather(reminder_task, analytics_task, return_exceptions=True)
+        close_analytics_db()
 
 
 if __name__ == "__main__":